@@ -1,7 +1,45 @@
+import functools
+import logging
+
 import numpy as np
-from collections import Counter
 
-from pygame.transform import threshold
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:  # без numba используется векторизованная реализация на numpy
+    NUMBA_AVAILABLE = False
+
+_log = logging.getLogger(__name__)
+
+# глубже этого дерево не разворачивается во вложенные условия: у Python ограничено число уровней отступа
+_CODEGEN_MAX_DEPTH = 64
+# генерация стоит около 10 мкс на узел; большие деревья предсказываются пакетным спуском
+_CODEGEN_MAX_NODES = 8192
+# на больших выборках пакетный спуск по массивам узлов быстрее построчного вызова сгенерированной функции
+_CODEGEN_MAX_ROWS = 1024
+# единый ключ для всех пропусков: разные объекты NaN не равны друг другу и дали бы разные категории
+_NAN_CATEGORY = float("nan")
+
+
+def _category_key(value):
+    """
+    Возвращает ключ словаря категорий для значения признака: все NaN сводятся к одному ключу.
+    """
+    return _NAN_CATEGORY if value != value else value
+
+
+def _midpoints(lower, upper):
+    """
+    Возвращает пороги между соседними значениями признака `lower < upper`.
+
+    Порог — середина отрезка, но середина соседних чисел с плавающей точкой округляется к одному
+    из концов, а у отрезка от -inf до inf не определена. Тогда порогом берется `upper`: правило
+    `x < threshold` по-прежнему отправляет `lower` влево, а `upper` вправо.
+    """
+    # сумма бесконечных концов или очень больших чисел дает nan или inf, такие середины отбрасываются
+    with np.errstate(invalid="ignore", over="ignore"):
+        middle = (lower + upper) / 2
+    return np.where((lower < middle) & (middle <= upper), middle, upper)
 
 
 def find_best_split(feature_vector, target_vector):
@@ -61,39 +99,305 @@ def find_best_split(feature_vector, target_vector):
     sorted_features = feature_values[order]
     sorted_targets = target_classes[order]
 
-    thresholds = (np.unique(sorted_features[1:]) + np.unique(sorted_features[:-1])) / 2 # проги
-    unique_thresholds = np.unique(thresholds)
+    # позиции, на которых значение признака возрастает, — это и есть индексы разделения;
+    # NaN ни с чем не сравнимы и отделить их порогом нельзя, поэтому они остаются в последней группе
+    change = np.flatnonzero(sorted_features[1:] > sorted_features[:-1]) + 1
+    thresholds = _midpoints(sorted_features[change - 1], sorted_features[change]) # проги
+
+    n_objects = len(sorted_targets)
+
+    # объекты с одинаковым значением признака объединяются в группы, и кумулятивные суммы
+    # считаются по группам (их на одну больше, чем порогов), а не по всем объектам
+    group_starts = np.concatenate(([0], change))
+    group_ones = np.add.reduceat(sorted_targets, group_starts)
+    cumulative_sum = np.cumsum(group_ones) # кумулятивные суммы
+
+    # размеры и число объектов класса 1 слева и справа от порога;
+    # обе части непусты, так как 0 < change < n_objects, и деления на ноль не бывает
+    left_count = change
+    left_ones = cumulative_sum[:-1]
+    right_count = n_objects - left_count
+    right_ones = cumulative_sum[-1] - left_ones
+
+    # H(R) = 1 - p_1^2 - p_0^2 = 2 p_1 p_0, поэтому |R_l| / |R| * H(R_l) = 2 / |R| * ones_l * (|R_l| - ones_l) / |R_l|,
+    # и индекс Джини для всех порогов считается в двух буферах без промежуточных массивов
+    ginis = np.empty(change.size)
+    right_part = np.empty(change.size)
+    np.subtract(left_count, left_ones, out=ginis)
+    np.multiply(ginis, left_ones, out=ginis)
+    np.divide(ginis, left_count, out=ginis)
+    np.subtract(right_count, right_ones, out=right_part)
+    np.multiply(right_part, right_ones, out=right_part)
+    np.divide(right_part, right_count, out=right_part)
+    np.add(ginis, right_part, out=ginis)
+    np.multiply(ginis, -2 / n_objects, out=ginis)
 
-    cumulative_sum = np.cumsum(sorted_targets) # кумулятивные суммы
-    cumulative_count = np.arange(1, len(sorted_targets) + 1)
+    # поиск лучшего порога и соответствующего индекса Джини
+    best_index = np.argmax(ginis)
+    best_threshold = thresholds[best_index]
+    best_gini = ginis[best_index]
+    return thresholds, ginis, best_threshold, best_gini
 
-    split_indices = np.searchsorted(sorted_features, unique_thresholds) # индексы разделения
 
-    # доли классов слева и справа от порога
-    left_prob = np.take(cumulative_sum, split_indices - 1) / np.take(cumulative_count, split_indices - 1)
-    right_total = cumulative_sum[-1] - np.take(cumulative_sum, split_indices - 1)
-    right_count = len(sorted_targets) - np.take(cumulative_count, split_indices - 1)
-    right_prob = np.divide(right_total, right_count, out=np.zeros_like(right_total, dtype=float), where=right_count != 0)
+def _find_best_splits(feature_matrix, target_vector, sorted_indices):
+    """
+    Находит оптимальные пороги сразу для всех столбцов матрицы вещественных признаков.
 
-    # индексы Джини для левой и правой частей
-    h_left = 1 - left_prob ** 2 - (1 - left_prob) ** 2
-    h_right = 1 - right_prob ** 2 - (1 - right_prob) ** 2
+    Векторизованный аналог `find_best_split`: кумулятивные суммы и критерий Джини
+    считаются одним проходом по всем столбцам вместо цикла по признакам. Объекты
+    узла передаются уже упорядоченными по каждому признаку, поэтому сортировки нет.
 
-    # индекс Джини для каждого порога
-    ginis = (-np.take(cumulative_count, split_indices - 1) / len(sorted_features)) * h_left - ((len(sorted_targets) - np.take(cumulative_count, split_indices - 1)) / len(sorted_features)) * h_right
-    ginis = np.where(np.isnan(ginis), -np.inf, ginis)
+    Parameters
+    ----------
+    feature_matrix : np.ndarray
+        Матрица вещественнозначных признаков всей обучающей выборки размера (n_samples, n_features).
+    target_vector : np.ndarray
+        Вектор классов (0 или 1) всей обучающей выборки длины n_samples.
+    sorted_indices : np.ndarray
+        Матрица размера (n_objects, n_features): в столбце `j` индексы объектов узла,
+        упорядоченные по возрастанию признака `j`.
 
-    # поиск лучшего порога и соответствующего индекса Джини
-    best_index = np.argmax(ginis)
-    best_threshold = unique_thresholds[best_index]
-    best_gini = ginis[best_index]
-    return unique_thresholds, ginis, best_threshold, best_gini
-    print("Thresholds:", unique_thresholds)
-    print("Ginis:", ginis)
-    if len(unique_thresholds) == 0 or np.isnan(ginis).all():
-        return None, None, None, None
-    print("Feature vector:", feature_vector)
-    print("Target vector:", target_vector)
+    Returns
+    -------
+    thresholds_best : np.ndarray
+        Оптимальный порог для каждого признака.
+    ginis_best : np.ndarray
+        Оптимальное значение критерия Джини для каждого признака; для константных признаков `-np.inf`.
+
+    """
+    n_objects, n_features = sorted_indices.shape
+    columns = np.arange(n_features)
+
+    sorted_features = np.take_along_axis(feature_matrix, sorted_indices, axis=0)
+    sorted_targets = target_vector[sorted_indices]
+
+    cumulative_sum = sorted_targets.cumsum(axis=0)  # кумулятивные суммы
+
+    # размеры и число объектов класса 1 слева и справа от каждой позиции разбиения
+    left_count = np.arange(1, n_objects)[:, None]
+    right_count = n_objects - left_count
+    left_ones = cumulative_sum[:-1]
+    right_ones = cumulative_sum[-1] - left_ones
+
+    # индекс Джини через тождество H(R) = 2 p_1 p_0 (см. `find_best_split`)
+    ginis = -2 / n_objects * (left_ones * (left_count - left_ones) / left_count + right_ones * (right_count - right_ones) / right_count)
+    # между одинаковыми значениями признака и перед NaN порог провести нельзя
+    ginis[~(sorted_features[1:] > sorted_features[:-1])] = -np.inf
+
+    # первый максимум соответствует минимальному порогу
+    best_index = np.argmax(ginis, axis=0)
+    thresholds_best = _midpoints(sorted_features[best_index, columns], sorted_features[best_index + 1, columns])
+    return thresholds_best, ginis[best_index, columns]
+
+
+def _bin_features(feature_matrix, max_bins, argsort):
+    """
+    Разбивает значения каждого вещественного признака на не более чем `max_bins` корзин.
+
+    Если у признака не больше `max_bins` различных значений, границы корзин — середины между
+    соседними значениями, и поиск по корзинам делит обучающие объекты узла так же, как точный.
+    Сами пороги при этом могут отличаться: если между значениями объектов узла лежат несколько
+    границ, выбирается первая из них, а не середина между этими значениями. Иначе границами
+    служат квантили признака. Различные значения и квантили берутся из уже отсортированного
+    признака, поэтому повторной сортировки нет.
+
+    Parameters
+    ----------
+    feature_matrix : np.ndarray
+        Матрица вещественнозначных признаков размера (n_objects, n_features).
+    max_bins : int
+        Максимальное число корзин, не больше 256.
+    argsort : np.ndarray
+        Результат `np.argsort(feature_matrix, axis=0)`.
+
+    Returns
+    -------
+    binned_matrix : np.ndarray
+        Матрица номеров корзин (uint8) того же размера: объект попадает в корзину `b`,
+        если `bin_edges[b - 1] <= x < bin_edges[b]`.
+    bin_edges : np.ndarray
+        Матрица размера (n_features, max_bins - 1) с границами корзин, дополненная `np.nan`.
+    """
+    n_objects, n_features = feature_matrix.shape
+    binned_matrix = np.empty((n_objects, n_features), dtype=np.uint8, order="F")
+    bin_edges = np.full((n_features, max_bins - 1), np.nan)
+    for feature in range(n_features):
+        values = feature_matrix[:, feature]
+        sorted_values = values[argsort[:, feature]]
+        # NaN стоят в конце отсортированного признака; они правее любой границы и попадают в последнюю корзину
+        sorted_values = sorted_values[: len(sorted_values) - np.count_nonzero(np.isnan(sorted_values))]
+        n_values = len(sorted_values)
+        if n_values == 0:
+            binned_matrix[:, feature] = 0
+            continue
+        unique_values = sorted_values[np.concatenate(([True], sorted_values[1:] != sorted_values[:-1]))]
+        if len(unique_values) <= max_bins:
+            edges = _midpoints(unique_values[:-1], unique_values[1:])
+        else:
+            # квантили с линейной интерполяцией между соседними порядковыми статистиками, как в np.quantile
+            positions = np.linspace(0, n_values - 1, max_bins + 1)[1:-1]
+            lower = np.floor(positions).astype(np.intp)
+            fraction = positions - lower
+            quantiles = sorted_values[lower] * (1 - fraction) + sorted_values[np.minimum(lower + 1, n_values - 1)] * fraction
+            edges = np.unique(quantiles)
+        bin_edges[feature, : len(edges)] = edges
+        binned_matrix[:, feature] = np.searchsorted(edges, values, side="right")
+    return binned_matrix, bin_edges
+
+
+def _find_best_splits_hist(binned_matrix, target_vector, bin_edges):
+    """
+    Находит оптимальные пороги для всех признаков по гистограммам классов в корзинах.
+
+    Для каждого признака строится гистограмма числа объектов и объектов класса 1 по корзинам,
+    после чего критерий Джини считается только на границах корзин.
+
+    Parameters
+    ----------
+    binned_matrix : np.ndarray
+        Матрица номеров корзин объектов узла размера (n_objects, n_features), см. `_bin_features`.
+    target_vector : np.ndarray
+        Вектор классов объектов узла (0 или 1).
+    bin_edges : np.ndarray
+        Границы корзин размера (n_features, n_bins - 1).
+
+    Returns
+    -------
+    thresholds_best : np.ndarray
+        Оптимальный порог (граница корзины) для каждого признака.
+    ginis_best : np.ndarray
+        Оптимальное значение критерия Джини для каждого признака; `-np.inf`, если разбиения нет.
+    """
+    n_objects, n_features = binned_matrix.shape
+    n_bins = bin_edges.shape[1] + 1
+    columns = np.arange(n_features)
+
+    # гистограммы всех признаков строятся одним вызовом bincount со сдвигом номеров корзин (int32);
+    # для класса 1 берутся строки его объектов вместо bincount с весами, повторенными по признакам
+    flat_bins = binned_matrix + (columns * n_bins).astype(np.int32)
+    counts = np.bincount(flat_bins.ravel(), minlength=n_features * n_bins).reshape(n_features, n_bins)
+    ones = np.bincount(flat_bins[target_vector == 1].ravel(), minlength=n_features * n_bins).reshape(n_features, n_bins)
+
+    # размеры и число объектов класса 1 слева и справа от каждой границы
+    left_count = counts.cumsum(axis=1)[:, :-1]
+    left_ones = ones.cumsum(axis=1)[:, :-1]
+    right_count = n_objects - left_count
+    right_ones = left_ones[:, -1:] + ones[:, -1:] - left_ones
+
+    # индекс Джини через тождество H(R) = 2 p_1 p_0 (см. `find_best_split`); пустые части не рассматриваются
+    valid = (left_count > 0) & (right_count > 0)
+    ginis = np.full(left_count.shape, -np.inf)
+    ginis[valid] = -2 / n_objects * (
+        left_ones[valid] * (left_count[valid] - left_ones[valid]) / left_count[valid]
+        + right_ones[valid] * (right_count[valid] - right_ones[valid]) / right_count[valid]
+    )
+
+    best_index = np.argmax(ginis, axis=1)
+    return bin_edges[columns, best_index], ginis[columns, best_index]
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _find_best_split_nb(feature, target, order):
+        """
+        Скомпилированный аналог `find_best_split`, возвращающий только оптимальное разбиение.
+
+        Один проход по объектам узла `order`, уже упорядоченным по возрастанию признака: число
+        объектов класса 1 слева от порога накапливается инкрементально, критерий Джини считается
+        на месте без промежуточных массивов.
+
+        Returns
+        -------
+        threshold_best : float
+            Оптимальный порог для разбиения.
+        gini_best : float
+            Оптимальное значение критерия Джини.
+        found : bool
+            Найден ли хотя бы один порог (False для константного признака).
+        """
+        n = order.shape[0]
+
+        total_ones = 0.0
+        for i in range(n):
+            total_ones += target[order[i]]
+
+        left_ones = 0.0
+        threshold_best, gini_best, found = 0.0, 0.0, False
+        for i in range(1, n):
+            left_ones += target[order[i - 1]]
+            # порог проводится только между возрастающими значениями, см. `find_best_split`
+            if not feature[order[i]] > feature[order[i - 1]]:
+                continue
+
+            right_ones = total_ones - left_ones
+            gini = -2 / n * (left_ones * (i - left_ones) / i + right_ones * (n - i - right_ones) / (n - i))
+
+            # строгое сравнение: при равных значениях остается минимальный порог
+            if not found or gini > gini_best:
+                # середина соседних значений или правое значение, см. `_midpoints`
+                lower, upper = feature[order[i - 1]], feature[order[i]]
+                threshold_best = (lower + upper) / 2
+                if not lower < threshold_best <= upper:
+                    threshold_best = upper
+                gini_best = gini
+                found = True
+        return threshold_best, gini_best, found
+
+    @njit(cache=True, parallel=True)
+    def _find_best_splits_nb(feature_matrix, target, sorted_indices):
+        """
+        Параллельный по признакам аналог `_find_best_splits` на основе `_find_best_split_nb`.
+        """
+        n_features = feature_matrix.shape[1]
+        thresholds_best = np.full(n_features, np.nan)
+        ginis_best = np.full(n_features, -np.inf)
+        for feature in prange(n_features):
+            threshold, gini, found = _find_best_split_nb(feature_matrix[:, feature], target, sorted_indices[:, feature])
+            if found:
+                thresholds_best[feature] = threshold
+                ginis_best[feature] = gini
+        return thresholds_best, ginis_best
+
+    @njit(cache=True, parallel=True)
+    def _find_best_splits_hist_nb(binned_matrix, target, sample_indices, bin_edges):
+        """
+        Параллельный по признакам аналог `_find_best_splits_hist`.
+
+        Гистограммы корзин объектов узла `sample_indices` накапливаются одним проходом по номерам
+        корзин всей обучающей выборки, без копирования подматрицы узла.
+        """
+        n_objects = sample_indices.shape[0]
+        n_features = binned_matrix.shape[1]
+        n_bins = bin_edges.shape[1] + 1
+        thresholds_best = np.full(n_features, np.nan)
+        ginis_best = np.full(n_features, -np.inf)
+        for feature in prange(n_features):
+            counts = np.zeros(n_bins, dtype=np.int64)
+            ones = np.zeros(n_bins)
+            for i in range(n_objects):
+                bin_index = binned_matrix[sample_indices[i], feature]
+                counts[bin_index] += 1
+                ones[bin_index] += target[sample_indices[i]]
+            total_ones = ones.sum()
+
+            left_count, left_ones = 0, 0.0
+            for bin_index in range(n_bins - 1):
+                left_count += counts[bin_index]
+                left_ones += ones[bin_index]
+                # пустые части не рассматриваются
+                if left_count == 0 or left_count == n_objects:
+                    continue
+                right_count = n_objects - left_count
+                right_ones = total_ones - left_ones
+                gini = -2 / n_objects * (
+                    left_ones * (left_count - left_ones) / left_count
+                    + right_ones * (right_count - right_ones) / right_count
+                )
+                # строгое сравнение: при равных значениях остается минимальный порог
+                if gini > ginis_best[feature]:
+                    thresholds_best[feature] = bin_edges[feature, bin_index]
+                    ginis_best[feature] = gini
+        return thresholds_best, ginis_best
 
 
 class DecisionTree:
@@ -103,15 +407,18 @@ class DecisionTree:
         max_depth=None,
         min_samples_split=None,
         min_samples_leaf=None,
+        max_bins=None,
     ):
         if any(ft not in {"real", "categorical"} for ft in feature_types):
             raise ValueError("There is unknown feature type")
+        if max_bins is not None and not 2 <= max_bins <= 256:
+            raise ValueError("max_bins must be between 2 and 256")
 
-        self._tree = {}
         self._feature_types = feature_types
         self._max_depth = max_depth
         self._min_samples_split = min_samples_split
         self._min_samples_leaf = min_samples_leaf
+        self._max_bins = max_bins
 
     def get_params(self, deep=True):
         """
@@ -123,94 +430,202 @@ class DecisionTree:
             "max_depth": self._max_depth,
             "min_samples_split": self._min_samples_split,
             "min_samples_leaf": self._min_samples_leaf,
+            "max_bins": self._max_bins,
         }
 
-    def _fit_node(self, sub_X, sub_y, node):
-        print("Starting _fit_node")
-        print("Current depth:", getattr(node, "depth", "unknown"))
-        print("sub_X.shape:", sub_X.shape)
-        print("sub_y:", sub_y)
-
-        if np.all(sub_y == sub_y[0]):
-            print("Terminal node with class:", sub_y[0])
-            node["type"] = "terminal"
-            node["class"] = sub_y[0]
-            return
-
-        feature_best, threshold_best, gini_best, split = None, None, None, None
-
-        for feature in range(sub_X.shape[1]):
-            feature_type = self._feature_types[feature]
-            print(f"Checking feature {feature}, type: {feature_type}")
-
-            if feature_type == "real":
-                feature_vector = sub_X[:, feature]
-            elif feature_type == "categorical":
-                counts = Counter(sub_X[:, feature])
-                clicks = Counter(sub_X[sub_y == 1, feature])
-                ratio = {key: clicks.get(key, 0) / count for key, count in counts.items()}
-                sorted_categories = sorted(ratio, key=ratio.get)
-                categories_map = {category: i for i, category in enumerate(sorted_categories)}
-                feature_vector = np.vectorize(categories_map.get)(sub_X[:, feature])
-            else:
-                raise ValueError("Unknown feature type")
-
-            if len(np.unique(feature_vector)) <= 1:
-                print(f"Feature {feature} skipped: only one unique value")
-                continue
+    def _add_node(self, parent, is_left, value):
+        """
+        Добавляет в дерево новый терминальный узел и привязывает его к родителю.
 
-            thresholds, ginis, threshold, gini = find_best_split(feature_vector, sub_y)
-            print(f"Feature {feature}: Best threshold = {threshold}, Gini = {gini}")
+        Parameters
+        ----------
+        parent : int or None
+            Индекс родительского узла (None для корня).
+        is_left : bool
+            Является ли узел левым потомком родителя.
+        value : int
+            Номер предсказываемого в узле класса.
 
-            if gini_best is None or (gini is not None and gini > gini_best):
-                feature_best = feature
-                gini_best = gini
-                split = feature_vector < threshold
+        Returns
+        -------
+        int
+            Индекс добавленного узла.
+        """
+        node = len(self._node_is_leaf)
+        self._node_is_leaf.append(True)
+        self._node_feature.append(0)
+        self._node_threshold.append(np.nan)
+        self._node_cat_mask.append(np.zeros(self._n_cat_words, dtype=np.uint64))
+        self._node_left.append(-1)
+        self._node_right.append(-1)
+        self._node_value.append(value)
+
+        if parent is not None:
+            if is_left:
+                self._node_left[parent] = node
+            else:
+                self._node_right[parent] = node
+        return node
 
-                if feature_type == "real":
-                    threshold_best = threshold
-                elif feature_type == "categorical":
-                    threshold_best = [k for k, v in categories_map.items() if v < threshold]
+    def _fit_node(self, sample_indices, sorted_indices, parent, is_left):
+        """
+        Строит узел дерева по объектам `sample_indices` и возвращает задания на построение его потомков.
 
-        print("Best feature:", feature_best, "Best threshold:", threshold_best)
+        `sorted_indices` — те же объекты, упорядоченные по возрастанию каждого вещественного признака
+        (матрица размера (n_objects, n_real_features)), или None, если точный поиск порогов не используется.
 
-        else:
-                raise ValueError("Некорректный тип признака")
+        Returns
+        -------
+        list of tuple
+            Аргументы `_fit_node` для потомков узла; пустой список для терминального узла.
+        """
+        sub_y = self._y[sample_indices]
+        # отладочные сообщения формируются, только если уровень DEBUG включен
+        debug = _log.isEnabledFor(logging.DEBUG)
 
-            if len(np.unique(feature_vector)) <= 1:
+        node = self._add_node(parent, is_left, sub_y[0])
+        if debug:
+            _log.debug("Fitting node %d: %d objects, %d of class 1", node, len(sub_y), np.count_nonzero(sub_y == 1))
+        if np.all(sub_y == sub_y[0]):
+            if debug:
+                _log.debug("Node %d is terminal with class %s", node, self._classes[sub_y[0]])
+            return []
+
+        # лучшие пороги и значения Джини по каждому признаку
+        thresholds = np.full(self._X.shape[1], np.nan)
+        ginis = np.full(self._X.shape[1], -np.inf)
+        categories = {}
+
+        # все вещественные признаки обрабатываются одним векторизованным проходом
+        if self._real_features.size and self._max_bins is not None:
+            # разбиения ищутся только по границам корзин, см. `_bin_features`
+            if NUMBA_AVAILABLE:
+                thresholds[self._real_features], ginis[self._real_features] = _find_best_splits_hist_nb(
+                    self._X_binned, self._y, sample_indices, self._bin_edges
+                )
+            else:
+                thresholds[self._real_features], ginis[self._real_features] = _find_best_splits_hist(
+                    self._X_binned[sample_indices], sub_y, self._bin_edges
+                )
+        elif self._real_features.size:
+            if NUMBA_AVAILABLE:
+                thresholds[self._real_features], ginis[self._real_features] = _find_best_splits_nb(
+                    self._X_real, self._y, sorted_indices
+                )
+            else:
+                thresholds[self._real_features], ginis[self._real_features] = _find_best_splits(
+                    self._X_real, self._y, sorted_indices
+                )
+
+        for feature in self._categorical_features:
+            # критерий Джини не больше нуля: если на признаке с меньшим индексом уже найдено
+            # идеальное разбиение, остальные признаки его не превзойдут
+            if np.max(ginis[:feature], initial=-np.inf) > -1e-12:
+                break
+
+            # коды категорий заменяются рангами по доле объектов класса 1; коды — это номера
+            # 0, ..., n_categories - 1, поэтому частоты считаются bincount без сортировки
+            codes = self._X[sample_indices, feature].astype(np.intp)
+            counts = np.bincount(codes, minlength=len(self._categories[feature]))
+            node_categories = np.flatnonzero(counts)
+            # ранги различны у разных категорий, так что признак константен ровно при одной категории
+            if len(node_categories) <= 1:
+                if debug:
+                    _log.debug("Feature %d skipped: only one unique value", feature)
                 continue
 
-            _, _, threshold, gini = find_best_split(feature_vector, sub_y)
+            clicks = np.bincount(codes, weights=(sub_y == 1).astype(np.float64), minlength=len(counts))
+            ratio = clicks[node_categories] / counts[node_categories]
+            sorted_categories = node_categories[np.argsort(ratio, kind="stable")]
+            rank = np.empty(len(counts), dtype=np.int32)
+            rank[sorted_categories] = np.arange(len(sorted_categories), dtype=np.int32)
+            feature_vector = rank[codes]
 
-            if gini_best is None or (gini is not None and gini > gini_best):
-                feature_best = feature
-                gini_best = gini
-                split = feature_vector < threshold
+            _, _, threshold, gini = find_best_split(feature_vector, sub_y)
+            thresholds[feature] = threshold
+            ginis[feature] = gini
+            # пороги лежат посередине между соседними рангами, влево уходят ранги 0, ..., int(threshold)
+            categories[feature] = sorted_categories[: int(threshold) + 1]
 
-                if feature_type == "real":
-                    threshold_best = threshold
-                elif feature_type == "categorical":
-                    threshold_best = [k for k, v in categories_map.items() if v < threshold]
+        # при равных значениях Джини выбирается признак с меньшим индексом
+        feature_best = int(np.argmax(ginis))
+        if debug:
+            _log.debug("Node %d: best feature %d, Gini %s", node, feature_best, ginis[feature_best])
 
-        if feature_best is None or threshold_best is None:
+        if not np.isfinite(ginis[feature_best]):
             # Если не нашли подходящего признака или порога
-            node["type"] = "terminal"
-            node["class"] = Counter(sub_y).most_common(1)[0][0]
-            return
-
-        node["type"] = "nonterminal"
-        node["feature_split"] = feature_best
+            self._node_value[node] = int(np.bincount(sub_y).argmax())
+            return []
 
         if self._feature_types[feature_best] == "real":
-            node["threshold"] = threshold_best
+            real_column = np.searchsorted(self._real_features, feature_best)
+            split = self._X_real[sample_indices, real_column] < thresholds[feature_best]
         elif self._feature_types[feature_best] == "categorical":
-            node["categories_split"] = threshold_best
+            split = np.isin(self._X[sample_indices, feature_best], categories[feature_best])
         else:
             raise ValueError("Некорректный тип признака")
 
-        node["left_child"], node["right_child"] = {}, {}
-        self._fit_node(sub_X[split], sub_y[split], node["left_child"])
-        self._fit_node(sub_X[~split], sub_y[~split], node["right_child"])
+        n_left = np.count_nonzero(split)
+        if n_left == 0 or n_left == len(split):
+            # порог не разделил объекты узла: узел остается терминальным
+            self._node_value[node] = int(np.bincount(sub_y).argmax())
+            return []
+
+        self._node_is_leaf[node] = False
+        self._node_feature[node] = feature_best
+        if self._feature_types[feature_best] == "real":
+            self._node_threshold[node] = thresholds[feature_best]
+        else:
+            # множество категорий левого поддерева хранится битовой маской по кодам категорий:
+            # бит `code & 63` слова `code >> 6`
+            left_codes = categories[feature_best]
+            np.bitwise_or.at(
+                self._node_cat_mask[node], left_codes >> 6, np.left_shift(np.uint64(1), (left_codes & 63).astype(np.uint64))
+            )
+
+        # порядок объектов по каждому признаку у потомков получается устойчивым разделением
+        # порядка родителя, без повторной сортировки
+        left_sorted, right_sorted = None, None
+        if sorted_indices is not None:
+            # общий для всех узлов буфер длины n: записываются и читаются только объекты узла
+            self._goes_left[sample_indices] = split
+            columns = sorted_indices.T
+            left_mask = self._goes_left[columns]
+            left_sorted = columns[left_mask].reshape(len(columns), -1).T
+            right_sorted = columns[~left_mask].reshape(len(columns), -1).T
+
+        # потомкам передаются индексы объектов, а не копии подматриц; левый потомок
+        # идет последним, чтобы из стека в `fit` он был извлечен первым
+        return [
+            (sample_indices[~split], right_sorted, node, False),
+            (sample_indices[split], left_sorted, node, True),
+        ]
+
+    def _goes_left_categorical(self, nodes, codes):
+        """
+        Проверяет попадание кодов категорий в битовые маски левых поддеревьев узлов `nodes`.
+
+        Проверка без ветвлений: из маски узла берется слово `code >> 6` и сдвигается на `code & 63`.
+        Неизвестные при обучении категории (код -1) отправляются в правое поддерево.
+        """
+        known = codes >= 0
+        codes = np.where(known, codes, 0)
+        words = self._node_cat_mask[nodes, codes >> 6]
+        return known & ((words >> (codes & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)
+
+    def _encode(self, X):
+        """
+        Переводит матрицу признаков в вещественную матрицу для построения дерева и предсказания.
+
+        Категориальные значения заменяются номерами категорий среди встреченных при обучении,
+        неизвестные категории — значением -1.
+        """
+        X_encoded = np.empty(X.shape, dtype=float, order="F")
+        X_encoded[:, self._real_features] = X[:, self._real_features].astype(float)
+        for feature in self._categorical_features:
+            categories = self._categories[feature]
+            X_encoded[:, feature] = [categories.get(_category_key(value), -1) for value in X[:, feature].tolist()]
+        return X_encoded
 
     def _predict_node(self, x, node):
         """
@@ -222,9 +637,9 @@ class DecisionTree:
         Parameters
         ----------
         x : np.ndarray
-            Вектор признаков одного объекта.
-        node : dict
-            Узел дерева решений.
+            Вектор признаков одного объекта, закодированный `_encode`.
+        node : int
+            Индекс узла дерева решений.
 
         Returns
         -------
@@ -232,25 +647,151 @@ class DecisionTree:
             Предсказанный класс объекта.
         """
         # ╰( ͡☉ ͜ʖ ͡☉ )つ──☆*:・ﾟ   ฅ^•ﻌ•^ฅ   ʕ•ᴥ•ʔ
-        if node["type"] == "terminal":
-            return node["class"]
+        if self._node_is_leaf[node]:
+            return self._classes[self._node_value[node]]
 
-        feature = node["feature_split"]
+        feature = self._node_feature[node]
         if self._feature_types[feature] == "real":
-            threshold = node["threshold"]
+            goes_left = x[feature] < self._node_threshold[node]
         else:
-            threshold = node["categories_split"]
+            goes_left = self._goes_left_categorical(np.array([node]), np.array([x[feature]], dtype=np.intp))[0]
 
-        if self._feature_types[feature] == 'real':
-            return self._predict_node(x, node["left_child"]) if x[feature] < threshold else self._predict_node(x, node["right_child"])
-        else:
-            return self._predict_node(x, node["left_child"]) if x[feature] in threshold else self._predict_node(x, node["right_child"])
+        return self._predict_node(x, self._node_left[node]) if goes_left else self._predict_node(x, self._node_right[node])
+
+    def _generate_predict(self):
+        """
+        Генерирует функцию предсказания для одного объекта, в которой обученное дерево развернуто во вложенные условия.
+
+        Пороги, признаки, классы и битовые маски категорий подставляются в исходный код константами,
+        так что при предсказании нет ни обращений к массивам узлов, ни рекурсивных вызовов.
+        Сгенерированная функция принимает строку матрицы, закодированной `_encode`, в виде списка
+        и возвращает номер класса.
+
+        Returns
+        -------
+        callable or None
+            Скомпилированная функция или None, если дерево глубже `_CODEGEN_MAX_DEPTH`
+            или в нем больше `_CODEGEN_MAX_NODES` узлов.
+        """
+        if len(self._node_is_leaf) > _CODEGEN_MAX_NODES:
+            return None
+
+        lines = ["def _predict_one(x):"]
+        # обход в глубину: сначала условие и левое поддерево, затем else и правое поддерево
+        stack = [(0, 1)]
+        while stack:
+            node, depth = stack.pop()
+            indent = "    " * depth
+            if node is None:
+                lines.append(f"{indent}else:")
+            elif depth > _CODEGEN_MAX_DEPTH:
+                return None
+            elif self._node_is_leaf[node]:
+                lines.append(f"{indent}return {self._node_value[node]}")
+            else:
+                feature = self._node_feature[node]
+                if self._feature_is_real[feature]:
+                    condition = f"x[{feature}] < {float(self._node_threshold[node])!r}"
+                else:
+                    # слова маски склеиваются в одно целое число Python произвольной длины
+                    cat_mask = sum(int(word) << (64 * i) for i, word in enumerate(self._node_cat_mask[node]))
+                    condition = f"x[{feature}] >= 0 and ({cat_mask} >> int(x[{feature}])) & 1"
+                lines.append(f"{indent}if {condition}:")
+                stack.extend([(self._node_right[node], depth + 1), (None, depth), (self._node_left[node], depth + 1)])
+
+        # repr бесконечных и неопределенных порогов — имена inf и nan
+        namespace = {"inf": np.inf, "nan": np.nan}
+        exec(compile("\n".join(lines), "<decision tree>", "exec"), namespace)
+        return namespace["_predict_one"]
+
+    @functools.cached_property
+    def _predict_one(self):
+        """
+        Функция предсказания для одного объекта, см. `_generate_predict`.
+
+        Генерируется при первом предсказании небольшой выборки и сбрасывается при каждом обучении.
+        """
+        return self._generate_predict()
+
+    def __getstate__(self):
+        # сгенерированную функцию pickle сохранить не может; после загрузки она строится заново
+        state = self.__dict__.copy()
+        state.pop("_predict_one", None)
+        return state
 
     def fit(self, X, y):
-        self._fit_node(X, y, self._tree)
+        X, y = np.asarray(X), np.asarray(y)
+        feature_types = np.array(self._feature_types)
+        self._feature_is_real = feature_types == "real"
+        self._real_features = np.flatnonzero(self._feature_is_real)
+        self._categorical_features = np.flatnonzero(feature_types == "categorical")
+
+        # категории нумеруются в порядке первого появления через словарь: значения столбца
+        # могут быть несравнимы между собой (строки вместе с NaN или числами), поэтому без сортировки
+        self._categories = {
+            feature: {
+                category: code
+                for code, category in enumerate(dict.fromkeys(map(_category_key, X[:, feature].tolist())))
+            }
+            for feature in self._categorical_features
+        }
+        # число 64-битных слов в битовой маске категорий одного узла
+        self._n_cat_words = max([1] + [(len(categories) + 63) // 64 for categories in self._categories.values()])
+
+        # классы заменяются их номерами 0, 1, ..., чтобы подсчеты по классам сводились к bincount
+        self._classes, self._y = np.unique(y, return_inverse=True)
+        self._X = self._encode(X)
+        self._X_real = np.asfortranarray(self._X[:, self._real_features])
+        # объекты упорядочиваются по каждому вещественному признаку один раз на всё дерево
+        self._argsort = np.asfortranarray(np.argsort(self._X_real, axis=0).astype(np.int32))
+        if self._max_bins is not None:
+            self._X_binned, self._bin_edges = _bin_features(self._X_real, self._max_bins, self._argsort)
+
+        # узлы дерева хранятся в параллельных массивах, во время обучения — в списках
+        self._node_is_leaf, self._node_feature, self._node_threshold, self._node_cat_mask = [], [], [], []
+        self._node_left, self._node_right, self._node_value = [], [], []
+        # узлы строятся из явного стека заданий вместо рекурсии
+        self._goes_left = np.empty(len(self._y), dtype=bool)
+        root_sorted = self._argsort if self._real_features.size and self._max_bins is None else None
+        work = [(np.arange(len(self._y)), root_sorted, None, None)]
+        while work:
+            work.extend(self._fit_node(*work.pop()))
+
+        # обучающие буферы нужны только при построении дерева, предсказание их не читает
+        del self._X, self._X_real, self._argsort, self._y, self._goes_left
+        if self._max_bins is not None:
+            del self._X_binned, self._bin_edges
+
+        self._node_is_leaf = np.array(self._node_is_leaf)
+        self._node_feature = np.array(self._node_feature, dtype=np.int32)
+        self._node_threshold = np.array(self._node_threshold)
+        self._node_cat_mask = np.array(self._node_cat_mask, dtype=np.uint64)
+        self._node_left = np.array(self._node_left, dtype=np.int32)
+        self._node_right = np.array(self._node_right, dtype=np.int32)
+        self._node_value = np.array(self._node_value, dtype=np.intp)
+
+        # функция предсказания прежнего дерева сбрасывается и при необходимости генерируется заново
+        self.__dict__.pop("_predict_one", None)
 
     def predict(self, X):
-        predicted = []
-        for x in X:
-            predicted.append(self._predict_node(x, self._tree))
-        return np.array(predicted)
\ No newline at end of file
+        X = self._encode(np.asarray(X))
+
+        if len(X) <= _CODEGEN_MAX_ROWS and self._predict_one is not None:
+            return self._classes[np.array([self._predict_one(x) for x in X.tolist()], dtype=np.intp)]
+
+        # все объекты спускаются по дереву одновременно, по одному уровню за итерацию
+        node_idx = np.zeros(len(X), dtype=np.int32)
+        active = np.flatnonzero(~self._node_is_leaf[node_idx])
+        while active.size:
+            nodes = node_idx[active]
+            features = self._node_feature[nodes]
+            values = X[active, features]
+
+            go_left = values < self._node_threshold[nodes]
+            categorical = ~self._feature_is_real[features]
+            go_left[categorical] = self._goes_left_categorical(nodes[categorical], values[categorical].astype(np.intp))
+
+            node_idx[active] = np.where(go_left, self._node_left[nodes], self._node_right[nodes])
+            active = active[~self._node_is_leaf[node_idx[active]]]
+
+        return self._classes[self._node_value[node_idx]]